@@ -1,29 +1,203 @@
 import os
 import re
+import hashlib
+import marshal
 import time
 import sys
 from io import StringIO
+from types import MappingProxyType
+from concurrent.futures import ProcessPoolExecutor
 import contextlib
+import ctypes
+import tempfile
+import textwrap
+import matplotlib
+
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import numpy as np
 
 
+STDOUT_BUFFER = StringIO()
+NO_ATTRIBUTES = MappingProxyType({})
+ATTR_CACHE = {}
+CODE_CACHE = {}
+USED_SNIPPETS = set()
+SLICE_CACHE = {}
+FIGURE_STATES = {}
+CODE_CACHE_FILE = os.path.join(
+    ".cache", "snippets.{}.marshal".format(sys.implementation.cache_tag)
+)
+
+
+_INLINE_RE = re.compile(
+    r"`([^`]+)`|\*\*([^\*]+)\*\*|\*([^\*]+)\*|\[([^\]]+)\]\(([^\)]+)\)"
+)
+
+_META_RE = re.compile(r"[$`*\[]")
+_DISPLAY_EQ_RE = re.compile(r"\$\$(?:.*?\$\$|.*)", re.S)
+_INLINE_EQ_RE = re.compile(r"\$(?:[^$]*\$|.*)", re.S)
+_DATA_RE = re.compile(r"@data\.[a-zA-Z_\-\[\]\d:]+")
+_DATA_KEY_RE = re.compile(r"([^\[\s]+)([^\s]*)")
+_RNG_RE = re.compile(r"\[([^\]]+)\]")
+_LIST_LINK_RE = re.compile(r"<<([^>]+)>>(.*)")
+_PLACEHOLDER_RE = re.compile(r"(\{\{content\}\}|\{\{script\}\})")
+
+
+def _inline_repl(m):
+    # code spans are emitted verbatim, other markup may nest inside bold,
+    # italic and link texts
+    if m.lastindex == 1:
+        return "<code>{}</code>".format(m.group(1))
+    if m.lastindex == 2:
+        return "<b>{}</b>".format(_INLINE_RE.sub(_inline_repl, m.group(2)))
+    if m.lastindex == 3:
+        return "<i>{}</i>".format(_INLINE_RE.sub(_inline_repl, m.group(3)))
+    return "<a href='{}'>{}</a>".format(
+        m.group(5), _INLINE_RE.sub(_inline_repl, m.group(4))
+    )
+
+
 @contextlib.contextmanager
-def stdoutIO(stdout=None):
-    old = sys.stdout
-    if stdout is None:
-        stdout = StringIO()
-    sys.stdout = stdout
-    yield stdout
-    sys.stdout = old
+def fd_stdout_to_sys_stdout():
+    # compiled code may write to the C-level stdout, which bypasses
+    # sys.stdout (and redirect_stdout); route file descriptor 1 through a
+    # temporary file and forward what was written to sys.stdout
+    sys.stdout.flush()
+    saved = os.dup(1)
+    with tempfile.TemporaryFile() as tmp:
+        os.dup2(tmp.fileno(), 1)
+        try:
+            yield
+        finally:
+            try:
+                ctypes.CDLL(None).fflush(None)
+            except (OSError, AttributeError, TypeError):
+                pass
+            os.dup2(saved, 1)
+            os.close(saved)
+            tmp.seek(0)
+            sys.stdout.write(tmp.read().decode(errors="replace"))
+
+
+def jit_exec(pgm):
+    # runs the snippet as the body of a nopython function; returns False
+    # when numba is missing or cannot compile it, so that the caller can
+    # fall back to a plain exec
+    try:
+        import numba
+    except ImportError:
+        return False
+    scope = dict(globals())
+    try:
+        exec("def _kernel():\n    pass\n" + textwrap.indent(pgm, "    "), scope)
+    except SyntaxError:
+        return False
+    kernel = numba.njit(scope["_kernel"])
+    try:
+        kernel.compile(())
+    except Exception:
+        return False
+    with fd_stdout_to_sys_stdout():
+        kernel()
+    return True
+
+
+def load_code_cache():
+    # a no-op in forked workers, which inherit the cache of the parent
+    if CODE_CACHE or not os.path.exists(CODE_CACHE_FILE):
+        return
+    with open(CODE_CACHE_FILE, "rb") as f:
+        try:
+            CODE_CACHE.update(marshal.load(f))
+        except (EOFError, ValueError, TypeError):
+            pass
+
+
+def save_code_cache(entries):
+    # only the snippets used by this run are kept, so that edited snippets
+    # and snippets with stale @data values do not accumulate
+    os.makedirs(os.path.dirname(CODE_CACHE_FILE), exist_ok=True)
+    with open(CODE_CACHE_FILE, "wb") as f:
+        marshal.dump(entries, f)
+
+
+def compile_snippet(pgm):
+    key = hashlib.sha1(pgm.encode()).digest()
+    if key not in CODE_CACHE:
+        CODE_CACHE[key] = compile(pgm, f"<snippet:{key.hex()[:8]}>", "exec")
+    USED_SNIPPETS.add(key)
+    return CODE_CACHE[key]
+
+
+def run_snippet(pgm, doc, jit=False):
+    if jit and jit_exec(pgm):
+        return
+    exec(compile_snippet(pgm))
+
+
+def figure_state(fig=None):
+    # figure-level settings that survive plt.clf(); without a figure,
+    # returns those of a new figure, computed once
+    if fig is None:
+        if "default" not in FIGURE_STATES:
+            FIGURE_STATES["default"] = figure_state(Figure())
+        return FIGURE_STATES["default"]
+    params = fig.subplotpars
+    return (
+        tuple(fig.get_size_inches()),
+        fig.get_dpi(),
+        tuple(fig.get_facecolor()),
+        tuple(fig.get_edgecolor()),
+        fig.get_frameon(),
+        (params.left, params.right, params.bottom, params.top),
+        (params.wspace, params.hspace),
+        type(fig.get_layout_engine()),
+    )
+
+
+def parse_idstr(idstr):
+    # "@data.x[0][:10:2]" -> ("x", (0, slice(None, 10, 2)))
+    if idstr not in SLICE_CACHE:
+        assert idstr.startswith("@data.")
+        m = _DATA_KEY_RE.match(idstr[len("@data.") :])
+        if m is None:
+            raise ValueError(f"Could not parse {idstr}")
+        indexers = []
+        for rng in _RNG_RE.findall(m.group(2)):
+            if ":" not in rng:
+                indexers.append(int(rng))
+            else:
+                parts = rng.split(":")
+                if len(parts) > 3:
+                    raise ValueError(f"Could not parse {idstr}")
+                indexers.append(slice(*[int(p) if p else None for p in parts]))
+        SLICE_CACHE[idstr] = (m.group(1), tuple(indexers))
+    return SLICE_CACHE[idstr]
 
 
 def arr2str(arr):
-    if len(arr.shape) == 1:
-        return "[{}]".format(", ".join(list(map(str, arr))))
+    if arr.ndim == 0:
+        return str(arr)
+    if arr.ndim == 1:
+        return "[{}]".format(", ".join(map(str, arr)))
     return "[{}]".format(", ".join([arr2str(x) for x in arr]))
 
 
+class Cursor(object):
+    def __init__(self, lines):
+        self.lines = lines
+        self.index = 0
+
+    def readline(self):
+        if self.index >= len(self.lines):
+            return ""
+        line = self.lines[self.index]
+        self.index += 1
+        return line
+
+
 class Renderable(object):
     def __init__(self):
         self.content = []
@@ -38,32 +212,41 @@ class Renderable(object):
 class Parseable(Renderable):
 
     ATTRIBUTES = []
+    ATTR_MAP = {}
 
     def __init__(self):
         super(Parseable, self).__init__()
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.ATTR_MAP = dict(cls.ATTRIBUTES)
+
     @classmethod
     def parse(cls, line, f, doc):
         raise NotImplementedError()
 
     @classmethod
     def parse_attr(cls, line, f, doc, attrs):
-        for attr, default in cls.ATTRIBUTES:
-            if line.startswith(f"{attr}="):
-                value = line.replace(f"{attr}=", "").strip()
-                if isinstance(default, bool):
-                    value = value.lower() in ("true", "yes", "t", 1, "y")
-                elif isinstance(default, float):
-                    value = float(value)
-                elif isinstance(default, int):
-                    value = int(value)
-                attrs[attr] = value
-                line = f.readline()
-        return line
+        while True:
+            attr, eq, value = line.partition("=")
+            if not eq or attr not in cls.ATTR_MAP:
+                return line
+            default = cls.ATTR_MAP[attr]
+            value = value.strip()
+            if isinstance(default, bool):
+                value = value.lower() in ("true", "yes", "t", 1, "y")
+            elif isinstance(default, float):
+                value = float(value)
+            elif isinstance(default, int):
+                value = int(value)
+            attrs[attr] = value
+            line = f.readline()
 
     @classmethod
     def init_attributes(cls):
-        return dict(list(cls.ATTRIBUTES))
+        if not cls.ATTRIBUTES:
+            return NO_ATTRIBUTES
+        return dict(cls.ATTRIBUTES)
 
     @classmethod
     def parse_gen(cls, line, f, doc, attrs):
@@ -73,7 +256,8 @@ class Parseable(Renderable):
             return line, True
         if line.startswith("--"):
             return line, True
-        line = cls.parse_attr(line, f, doc, attrs)
+        if cls.ATTRIBUTES:
+            line = cls.parse_attr(line, f, doc, attrs)
         if line.startswith("__nop"):
             return line.replace("__nop", ""), False
         return line, False
@@ -86,17 +270,16 @@ class HtmlElement(Renderable):
         self.attrs = attrs
 
     def render(self):
-        attrs = " ".join(
-            ['{}="{}"'.format(key, value) for key, value in self.attrs.items()]
-        )
-        html = "<{} {}>".format(self.tag, attrs)
-        for c in self.content:
-            if isinstance(c, str):
-                html += c
-            else:
-                html += c.render()
-        html += "</{}>".format(self.tag)
-        return html
+        # insertion order is kept in the key so that the output is unchanged
+        key = tuple(self.attrs.items())
+        attrs = ATTR_CACHE.get(key)
+        if attrs is None:
+            attrs = " ".join(['{}="{}"'.format(k, v) for k, v in key])
+            ATTR_CACHE[key] = attrs
+        parts = ["<{} {}>".format(self.tag, attrs)]
+        parts.extend(c if isinstance(c, str) else c.render() for c in self.content)
+        parts.append("</{}>".format(self.tag))
+        return "".join(parts)
 
 
 class Text(object):
@@ -104,24 +287,27 @@ class Text(object):
         self.text = text
 
     def render(self):
-        segments = self.text.split("$$")
-        for si, seg in enumerate(segments):
-            if si % 2 == 1:
-                # inside an equation
-                continue
-            sub_segments = seg.split("$")
-            for sj, s in enumerate(sub_segments):
-                if sj % 2 == 1:
-                    # inside an equation
-                    continue
-                s = re.sub("`([^`]+)`", r"<code>\1</code>", s)
-                s = re.sub("\*\*([^\*]+)\*\*", r"<b>\1</b>", s)
-                s = re.sub("\*([^\*]+)\*", r"<i>\1</i>", s)
-                # s = re.sub("_([^_]+)_", r"<u>\1</u>", s)
-                s = re.sub("\[([^\]]+)\]\(([^\)]+)\)", r"<a href='\2'>\1</a>", s)
-                sub_segments[sj] = s
-            segments[si] = "$".join(sub_segments)
-        return "$$".join(segments)
+        if _META_RE.search(self.text) is None:
+            return self.text
+        # equations are copied verbatim, inline markup is applied in between;
+        # $$ spans are located first so that a lone $ never pairs with one
+        parts = []
+        pos = 0
+        for m in _DISPLAY_EQ_RE.finditer(self.text):
+            self.render_segment(self.text[pos : m.start()], parts)
+            parts.append(m.group(0))
+            pos = m.end()
+        self.render_segment(self.text[pos:], parts)
+        return "".join(parts)
+
+    @staticmethod
+    def render_segment(segment, parts):
+        pos = 0
+        for m in _INLINE_EQ_RE.finditer(segment):
+            parts.append(_INLINE_RE.sub(_inline_repl, segment[pos : m.start()]))
+            parts.append(m.group(0))
+            pos = m.end()
+        parts.append(_INLINE_RE.sub(_inline_repl, segment[pos:]))
 
 
 class Image(Parseable):
@@ -174,7 +360,7 @@ class Javascript(Parseable):
             else:
                 lines.append(line)
                 line = f.readline()
-        doc.js += lines
+        doc.js.write("".join(lines))
         return line, cls()
 
 
@@ -206,7 +392,7 @@ class Html(Parseable):
 
 class Python(Parseable):
 
-    ATTRIBUTES = [("print", "result")]
+    ATTRIBUTES = [("print", "result"), ("jit", False)]
 
     def __init__(self, html):
         super(Python, self).__init__()
@@ -228,10 +414,14 @@ class Python(Parseable):
                 lines.append(doc.replace_data(line))
                 line = f.readline()
         pgm = "".join(lines)
-        with stdoutIO() as s:
-            exec(pgm)
-
-        return line, cls(s.getvalue())
+        if attrs["print"] != "result":
+            run_snippet(pgm, doc, attrs["jit"])
+            return line, cls("")
+        STDOUT_BUFFER.seek(0)
+        STDOUT_BUFFER.truncate()
+        with contextlib.redirect_stdout(STDOUT_BUFFER):
+            run_snippet(pgm, doc, attrs["jit"])
+        return line, cls(STDOUT_BUFFER.getvalue())
 
 
 class Pyplot(Parseable):
@@ -261,9 +451,15 @@ class Pyplot(Parseable):
             else:
                 lines.append(doc.replace_data(line))
                 line = f.readline()
-        lines += ["plt.savefig('{}')\n".format(src), "plt.close()\n"]
-        exec("".join(lines))
-
+        run_snippet("".join(lines), doc)
+        plt.savefig(src)
+        # clear the figure so that the next block reuses it, unless the
+        # snippet created figures of its own or changed the figure itself
+        # (size, dpi, colors, margins...), which clf() would not undo
+        if len(plt.get_fignums()) == 1 and figure_state(plt.gcf()) == figure_state():
+            plt.clf()
+        else:
+            plt.close("all")
         return line, cls(src)
 
 
@@ -292,7 +488,7 @@ class Plotly(Parseable):
             else:
                 lines.append(doc.replace_data(line))
                 line = f.readline()
-        doc.js += lines
+        doc.js.write("".join(lines))
         return line, cls(container)
 
 
@@ -436,11 +632,10 @@ class CodeSnippet(Parseable):
                     line = f.readline()
                 except:
                     break
-        i = len(text) - 1
-        while i > 0 and text[i].strip() == "":
-            i -= 1
-        text = text[: i + 1]
-        return line, cls("".join(text), ctype=attrs["type"])
+        src = "".join(text).rstrip()
+        if src:
+            src += "\n"
+        return line, cls(src, ctype=attrs["type"])
 
 
 class SvgList(Parseable):
@@ -543,7 +738,7 @@ class List(Parseable):
                 continue
             else:
                 if line.startswith("<<"):
-                    m = re.match("<<([^>]+)>>(.*)", line.strip())
+                    m = _LIST_LINK_RE.match(line.strip())
                     if m is not None:
                         items.append((m.group(2), m.group(1)))
                     else:
@@ -554,6 +749,19 @@ class List(Parseable):
         return line, cls(items, **attrs)
 
 
+TEMPLATES = {}
+
+
+def load_template(name):
+    # the template is split around its placeholders: odd items are the
+    # placeholders themselves, each of which may appear any number of times
+    if name not in TEMPLATES:
+        template_file = os.path.join("templates", "{}.html".format(name))
+        with open(template_file) as f:
+            TEMPLATES[name] = _PLACEHOLDER_RE.split(f.read())
+    return TEMPLATES[name]
+
+
 REGISTER = {
     "fst-list": SvgList,
     "svg-list": SvgList,
@@ -632,7 +840,10 @@ class Section(Renderable):
             if line.startswith("id="):
                 self.id = line.strip()[3:]
             elif line.startswith("--"):
-                cls = REGISTER[line.strip().replace("--", "").strip()]
+                key = line[2:].strip()
+                cls = REGISTER.get(key)
+                if cls is None:
+                    raise ValueError("Unknown element --{}".format(key))
                 line, obj = cls.parse(line, f, doc)
                 self.content.append(obj)
             elif line.startswith("["):
@@ -650,65 +861,30 @@ class Document(Renderable):
         self.content = []
         self.accordion = False
         self.template = "default"
-        self.js = []
+        self.js = StringIO()
         self.name = name
         self.data = data
+        self._data_cache = {}
 
     def get_data(self, idstr, to_str=False):
+        # only the serialized form is memoized, per document, since that is
+        # what replace_data asks for; arrays are sliced on each call
+        if to_str:
+            if idstr not in self._data_cache:
+                self._data_cache[idstr] = arr2str(self.get_data(idstr))
+            return self._data_cache[idstr]
         if self.data is None:
             raise ValueError("No data found for doc")
-        assert idstr.startswith("@data.")
-        s = idstr.replace("@data.", "")
-        m = re.match(r"([^\[\s]+)([^\s]*)", s)
-        if m is None:
-            raise ValueError(f"Could not parse {idstr}")
-        if m.group(1) not in self.data:
-            raise ValueError("No key for {}".format(m.group(1)))
-        arr = self.data[m.group(1)]
-        if m.group(2) == "":
-            if to_str:
-                return arr2str(arr)
-            return arr
-        rngs = re.findall(r"\[([^\]]+)\]", m.group(2))
-        for rng in rngs:
-            if ":" not in rng:
-                arr = arr[int(rng)]
-            else:
-                _slice = rng.split(":")
-                if _slice[0] == "":
-                    if _slice[1] == "":
-                        if len(_slice) > 2:
-                            arr = arr[:: int(_slice[2])]
-                        else:
-                            raise RuntimeError()
-                    else:
-                        if len(_slice) > 2:
-                            arr = arr[: int(_slice[1]) : int(_slice[2])]
-                        else:
-                            arr = arr[: int(_slice[1])]
-                else:
-                    if len(_slice) == 1:
-                        arr = arr[int(_slice[0])]
-                    elif _slice[1] == "":
-                        if len(slice) > 2:
-                            arr = arr[int(_slice[0]) :: int(_slice[2])]
-                        else:
-                            arr = arr[int(_slice[0]) :]
-                    else:
-                        if len(slice) > 2:
-                            arr = arr[int(_slice[0]) : int(_slice[1]) : int(_slice[2])]
-                        else:
-                            arr = arr[int(_slice[0]) : int(_slice[1])]
-        if to_str:
-            return arr2str(arr)
+        key, indexers = parse_idstr(idstr)
+        if key not in self.data:
+            raise ValueError("No key for {}".format(key))
+        arr = self.data[key]
+        for indexer in indexers:
+            arr = arr[indexer]
         return arr
 
     def replace_data(self, line):
-        data_to_replace = re.findall(r"@data\.[a-zA-Z-_\[\]\d:]+", line)
-        new_line = line
-        for x in data_to_replace:
-            new_line = new_line.replace(x, self.get_data(x, to_str=True))
-        return new_line
+        return _DATA_RE.sub(lambda m: self.get_data(m.group(0), to_str=True), line)
 
     def navbar(self):
         nav = HtmlElement(
@@ -782,10 +958,10 @@ class Document(Renderable):
                 continue
             elif prelude and not line.startswith("["):
                 if line.startswith("accordion="):
-                    value = line.replace("accordion=", "").strip()
+                    value = line[len("accordion=") :].strip()
                     self.accordion = value.lower() in ("true", "1", "y", "yes")
                 if line.startswith("template="):
-                    self.template = line.replace("template=", "").strip()
+                    self.template = line[len("template=") :].strip()
                 line = f.readline()
             elif line.startswith("["):
                 prelude = False
@@ -803,33 +979,92 @@ class Document(Renderable):
         return line, self
 
     def save(self):
-        template_file = os.path.join("templates", "{}.html".format(self.template))
-        source = open(template_file).read()
-        source = source.replace("{{content}}", self.render())
-        source = source.replace("{{script}}", "".join(self.js))
+        parts = load_template(self.template)
+        # render before opening the output, so that a failing render does not
+        # leave a truncated page that looks up to date
+        values = {"{{content}}": self.render(), "{{script}}": self.js.getvalue()}
         with open(self.name + ".html", "w") as f:
-            f.write(source)
+            for i, part in enumerate(parts):
+                f.write(values[part] if i % 2 else part)
+
+
+def scan(folder):
+    if not os.path.isdir(folder):
+        return {}
+    with os.scandir(folder) as it:
+        return {entry.name: entry for entry in it}
+
+
+def up_to_date(output, mtimes):
+    return output is not None and max(mtimes) <= output.stat().st_mtime
+
+
+def process_report(basename, raw_file, data_file, plot_folder):
+    # runs in a worker process; returns the snippets it used so that the
+    # parent can persist them in the code cache
+    print(f"-- making '{basename}'")
+    USED_SNIPPETS.clear()
+    data = None
+    if data_file is not None:
+        print("   ---> found data")
+        data = np.load(data_file)
+    if plot_folder is not None:
+        with os.scandir(plot_folder) as it:
+            for plot_file in it:
+                os.remove(plot_file.path)
+    doc = Document(basename, data=data)
+    with open(raw_file) as f:
+        cursor = Cursor(f.readlines())
+    doc.parse(cursor.readline(), cursor)
+    doc.save()
+    return marshal.dumps({k: CODE_CACHE[k] for k in USED_SNIPPETS})
 
 
 def main():
-    for filename in os.listdir("reports"):
+    load_code_cache()
+    outputs = scan(".")
+    data_files = scan("data")
+    plot_folders = scan("plots")
+    # the template is only known after parsing, so any template change
+    # (or a change to this script) triggers a rebuild
+    common_mtimes = [os.path.getmtime(__file__)] + [
+        entry.stat().st_mtime for entry in scan("templates").values()
+    ]
+    jobs = []
+    for filename, entry in scan("reports").items():
         if filename.endswith(".txt"):
             basename = os.path.splitext(filename)[0]
-            print(f"-- making '{basename}'")
-            data = None
-            if os.path.exists(os.path.join("data", basename + ".npz")):
-                print("   ---> found data")
-                data = np.load(os.path.join("data", basename + ".npz"))
-            if os.path.exists(os.path.join("plots", basename)):
-                for plot_file in os.listdir(os.path.join("plots", basename)):
-                    os.remove(os.path.join("plots", basename, plot_file))
-            doc = Document(basename, data=data)
-            raw_file = os.path.join("reports", filename)
-            output_file = f"{basename}.html"
-            with open(raw_file) as f:
-                line = f.readline()
-                doc.parse(line, f)
-            doc.save()
+            data_entry = data_files.get(basename + ".npz")
+            mtimes = common_mtimes + [entry.stat().st_mtime]
+            if data_entry is not None:
+                mtimes.append(data_entry.stat().st_mtime)
+            if up_to_date(outputs.get(f"{basename}.html"), mtimes):
+                print(f"-- '{basename}' is up to date")
+                continue
+            plot_entry = plot_folders.get(basename)
+            jobs.append(
+                (
+                    basename,
+                    entry.path,
+                    data_entry.path if data_entry is not None else None,
+                    plot_entry.path if plot_entry is not None else None,
+                )
+            )
+    if not jobs:
+        return
+    if len(jobs) == 1:
+        # nothing to parallelize, spare the worker start-up
+        results = [process_report(*jobs[0])]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=min(len(jobs), os.cpu_count() or 1),
+            initializer=load_code_cache,
+        ) as executor:
+            results = list(executor.map(process_report, *zip(*jobs)))
+    used = {}
+    for compiled in results:
+        used.update(marshal.loads(compiled))
+    save_code_cache(used)
 
 
 if __name__ == "__main__":